@@ -16,78 +16,151 @@
 
 from cryptography import x509
 from prometheus_client import start_http_server, Gauge, Enum
+import asyncio
 import codecs
+import contextlib
+import hashlib
+import logging
 import signal
+import threading
+import time
+from typing import NamedTuple
 import ssl
-import pytz
 import yaml
 import re
 import os
-import time
 from dotenv import load_dotenv, find_dotenv
-import datetime
 
 load_dotenv(find_dotenv())
 
+_log_level_name = (os.environ.get("X509_LOG_LEVEL") or "INFO").upper()
+_log_level = logging.getLevelName(_log_level_name)
+logging.basicConfig(level=_log_level if isinstance(_log_level, int) else logging.INFO)
+log = logging.getLogger(__name__)
+if not isinstance(_log_level, int):
+	log.warning(f"Unknown X509_LOG_LEVEL '{_log_level_name}', using INFO")
+
+_HOST_RE = re.compile(r"X509_CONFIG_HOST_\d+", re.IGNORECASE)
+_LABEL_RE = re.compile(r"X509_CONFIG_LABEL_([A-Z0-9_-]+)", re.IGNORECASE)
+# a cached certificate with more than this much life left is re-read at most every
+# _REFETCH_SECONDS, or every other poll when the polling interval is longer than that
+_FAR_FROM_EXPIRY_SECONDS = 30 * 86400
+_REFETCH_SECONDS = 6 * 3600
+
+class BoundHost(NamedTuple):
+	"""Gauge children bound to one host's label values"""
+	labels: dict
+	not_after: Gauge
+	not_before: Gauge
+	expired: Gauge
+	read_errors: Gauge
+
 class AppConfig():
-	def __init__(self, file: str):
+	def __init__(self, file: str, strict: bool = False):
 		# set defaults for config from environment variables if they exist
 		self.metrics = {
-			"port": int(dict_get(os.environ, "X509_CONFIG_METRICS_PORT", "8932")),
-			"pollingInterval": int(dict_get(os.environ, "X509_CONFIG_METRICS_POLLING_INTERVAL", "43200"))
+			"port": int(os.environ.get("X509_CONFIG_METRICS_PORT") or "8932"),
+			"pollingInterval": int(os.environ.get("X509_CONFIG_METRICS_POLLING_INTERVAL") or "43200")
 		}
 		self.hosts = list()
 		self.labels = list()
+		self._file = file
+		self._mtime = None
 
 		try:
 			# check if file exists
 			if os.path.exists(file):
-				print(f"Loading config from {file}")
+				log.info(f"Loading config from {file}")
+				self._mtime = os.stat(file).st_mtime
 				with codecs.open(file, encoding="utf-8-sig", mode="r") as f:
 					settings = yaml.safe_load(f)
-					self.__dict__.update(settings)
+				if not isinstance(settings, dict):
+					raise yaml.YAMLError(f"Config file {file} does not contain a mapping")
+				self.__dict__.update(settings)
+			elif strict:
+				raise FileNotFoundError(f"Config file {file} not found")
 		except yaml.YAMLError as exc:
-			print(exc)
+			# a reload must not fall back to the environment hosts alone
+			if strict:
+				raise
+			log.error(exc)
 
 		env_hosts = self.find_hosts_from_environment()
 		if len(env_hosts) > 0:
 			# merge env_hosts with config file
 			self.hosts = self.hosts + env_hosts
-			print(f"Appended {len(env_hosts)} hosts from environment variables")
+			log.info(f"Appended {len(env_hosts)} hosts from environment variables")
+		# validate ports once at load instead of converting them on every poll
+		for host in self.hosts:
+			if not isinstance(host, dict) or not host.get('name') or host.get('port') is None:
+				raise ValueError(f"Host entry {host!r} must have a 'name' and a 'port'")
+			try:
+				host['port'] = int(host['port'])
+			except (TypeError, ValueError):
+				raise ValueError(f"Invalid port '{host['port']}' for host '{host['name']}'")
+			if not 1 <= host['port'] <= 65535:
+				raise ValueError(f"Port {host['port']} for host '{host['name']}' is out of range (1-65535)")
+			host['_key'] = f"{host['name']}:{host['port']}"
 		env_labels = self.find_labels_from_environment()
 		if len(env_labels) > 0:
 			# merge env_labels with config file
+			existing = {x['name'] for x in self.labels}
 			for label in env_labels:
 				# check if label already exists
-				if label['name'] not in [x['name'] for x in self.labels]:
-					print(f"adding label {label['name']} from environment variables")
+				if label['name'] not in existing:
+					log.info(f"adding label {label['name']} from environment variables")
 					self.labels.append(label)
-			print(f"Appended {len(env_labels)} labels from environment variables")
+					existing.add(label['name'])
+			log.info(f"Appended {len(env_labels)} labels from environment variables")
+
+	def maybe_reload(self):
+		"""Reload hosts from the config file if it changed since it was last read.
+
+		Returns True if the hosts were reloaded. Labels are part of the metric
+		definitions, so changing them still requires a restart.
+		"""
+		try:
+			mtime = os.stat(self._file).st_mtime
+		except OSError:
+			log.info(f"Config file {self._file} not found, skipping reload")
+			return False
+		if mtime == self._mtime:
+			log.info(f"Config file {self._file} unchanged, skipping reload")
+			return False
+		try:
+			reloaded = AppConfig(self._file, strict=True)
+		except Exception as exc:
+			log.error(f"Not reloading config, keeping the current hosts: {exc}")
+			return False
+		if reloaded.labels != self.labels:
+			log.warning("Label changes require a restart, keeping the current labels")
+		self.hosts = reloaded.hosts
+		self._mtime = reloaded._mtime
+		log.info(f"Reloaded {len(self.hosts)} hosts from {self._file}")
+		return True
 
 	def find_labels_from_environment(self):
 		labels = list()
-		for env in os.environ:
-			pattern = r"^X509_CONFIG_LABEL_([A-Z0-9_-]+)$"
-			if re.match(pattern, env, re.IGNORECASE | re.DOTALL):
-				print(f"Found Label from Environment Variable: {env}")
-				# get the capture group
-				label = re.search(pattern, env, re.IGNORECASE | re.DOTALL).group(1)
-				# get the value
-				value = os.environ[env]
+		env_items = list(os.environ.items())
+		for env, value in env_items:
+			match = _LABEL_RE.fullmatch(env)
+			if match:
+				log.info(f"Found Label from Environment Variable: {env}")
 				# add to labels
 				labels.append({
-					"name": label.lower(),
+					"name": match.group(1).lower(),
 					"value": value
 				})
 		return labels
 
 	def find_hosts_from_environment(self):
 		hosts = []
-		for env in os.environ:
-			if re.match(r"^X509_CONFIG_HOST_\d{1,}$", env, re.IGNORECASE | re.DOTALL):
-				print(f"Found Host from Environment Variable: {env}")
+		env_items = list(os.environ.items())
+		for env, value in env_items:
+			if _HOST_RE.fullmatch(env):
+				log.info(f"Found Host from Environment Variable: {env}")
 				# split value by :
-				values = os.environ[env].split(":")
+				values = value.split(":")
 				# check if we have 2 values
 				if len(values) == 2:
 					# add to hosts
@@ -101,6 +174,7 @@ class X509Metrics:
 	def __init__(self, config):
 			self.namespace = "x509"
 			self.polling_interval_seconds = config.metrics['pollingInterval']
+			self._refetch_seconds = max(_REFETCH_SECONDS, 2 * self.polling_interval_seconds)
 			self.config = config
 			labels = [
 				"host",
@@ -128,95 +202,234 @@ class X509Metrics:
 			self.host_read_errors = Gauge(namespace=self.namespace, name=f"host_read_errors", documentation="Indicates if there was an error reading the certificate", labelnames=["host"])
 			self.read_errors = Gauge(namespace=self.namespace, name=f"read_errors", documentation="Indicates if there was an error reading the certificate")
 			self.build_info = Gauge(namespace=self.namespace, name=f"build_info", documentation="A metric with a constant '1' value labeled with version", labelnames=["version", "ref", "build_date", "sha"])
-			ver = dict_get(os.environ, "APP_VERSION", "1.0.0-snapshot")
-			ref = dict_get(os.environ, "APP_BUILD_REF", "unknown")
-			build_date = dict_get(os.environ, "APP_BUILD_DATE", "unknown")
-			sha = dict_get(os.environ, "APP_BUILD_SHA", "unknown")
+			ver = os.environ.get("APP_VERSION") or "1.0.0-snapshot"
+			ref = os.environ.get("APP_BUILD_REF") or "unknown"
+			build_date = os.environ.get("APP_BUILD_DATE") or "unknown"
+			sha = os.environ.get("APP_BUILD_SHA") or "unknown"
 			self.build_info.labels(version=ver, ref=ref, build_date=build_date, sha=sha).set(1)
+			# created lazily on first fetch, then reused across polls
+			self._loop = None
+			# host key -> (sha256 fingerprint, labels, not_after ts, not_before ts, last fetched ts)
+			self._cert_cache = {}
+			# one context shared by every probe; we only read the certificate, so do not verify it.
+			# TLS sessions are deliberately not resumed or kept open across polls: a resumed
+			# handshake reports the certificate cached in the session and would hide a rotation.
+			self._ssl_ctx = ssl.create_default_context()
+			self._ssl_ctx.check_hostname = False
+			self._ssl_ctx.verify_mode = ssl.CERT_NONE
+			# host key -> BoundHost
+			self._bound = {}
+			# host keys polled by the previous fetch
+			self._host_keys = set()
+			self._stop = threading.Event()
+			self._wake = threading.Event()
+			# set from the SIGHUP handler, acted on by the metrics loop
+			self._reload_requested = False
 	def run_metrics_loop(self):
 		"""Metrics fetching loop"""
-		while True:
-			print(f"begin metrics fetch")
-			self.fetch()
-			time.sleep(self.polling_interval_seconds)
+		next_fetch = 0
+		while not self._stop.is_set():
+			if time.monotonic() >= next_fetch:
+				log.debug("begin metrics fetch")
+				self.fetch()
+				next_fetch = time.monotonic() + self.polling_interval_seconds
+			# returns early as soon as stop() or reload() wakes the loop
+			self._wake.wait(max(0, next_fetch - time.monotonic()))
+			self._wake.clear()
+			if self._reload_requested and not self._stop.is_set():
+				self._reload_requested = False
+				# poll right away if the hosts changed
+				if self.config.maybe_reload():
+					next_fetch = 0
+		if self._loop is not None:
+			self._loop.close()
+
+	def stop(self):
+		"""Wake the metrics loop and make it exit"""
+		self._stop.set()
+		self._wake.set()
 
-	def get_oid_attribute(self, nameObject, oid):
-		if nameObject.get_attributes_for_oid(oid):
-			return nameObject.get_attributes_for_oid(oid)[0].value
-		return None
+	def reload(self):
+		"""Ask the metrics loop to reload the config before its next poll"""
+		self._reload_requested = True
+		self._wake.set()
+
+	async def _probe_host(self, host, now):
+		"""Fetch and parse the certificate for a single host.
+
+		Returns a tuple of (labels, expiration_ts, issued_ts, err). Errors are
+		returned rather than raised so one bad host can't abort the batch.
+		"""
+		try:
+			host_key = host['_key']
+			cached = self._cert_cache.get(host_key)
+			# no need to hit the network while the cached certificate is far from expiry
+			if cached is not None and cached[2] - now > _FAR_FROM_EXPIRY_SECONDS and now - cached[4] < self._refetch_seconds:
+				return cached[1], cached[2], cached[3], None
+			# get host certificate
+			_, writer = await asyncio.wait_for(
+				asyncio.open_connection(host['name'], host['port'], ssl=self._ssl_ctx, server_hostname=host['name']),
+				timeout=10
+			)
+			try:
+				der = writer.get_extra_info('ssl_object').getpeercert(binary_form=True)
+			finally:
+				writer.close()
+				# let the TLS shutdown finish now; the loop does not run again until the next poll
+				with contextlib.suppress(Exception):
+					await asyncio.wait_for(writer.wait_closed(), timeout=5)
+			# skip parsing if the certificate has not changed since the last poll
+			# same bytes as x509_cert.fingerprint(hashes.SHA256()), without parsing first
+			cert_hash = hashlib.sha256(der).digest()
+			if cached is not None and cached[0] == cert_hash:
+				self._cert_cache[host_key] = cached[:4] + (now,)
+				return cached[1], cached[2], cached[3], None
+			# parse certificate
+			x509_cert = x509.load_der_x509_certificate(der)
+			# get expiration date
+			expiration_date = x509_cert.not_valid_after_utc
+			issued_date = x509_cert.not_valid_before_utc
+			serial = x509_cert.serial_number
+			issuer = _name_to_oid_map(x509_cert.issuer)
+			subject = _name_to_oid_map(x509_cert.subject)
+			# get labels
+			labels = {
+				"host": host_key,
+				"issuer_C": issuer.get(x509.oid.NameOID.COUNTRY_NAME),
+				"issuer_L": issuer.get(x509.oid.NameOID.LOCALITY_NAME),
+				"issuer_O": issuer.get(x509.oid.NameOID.ORGANIZATION_NAME),
+				"issuer_OU": issuer.get(x509.oid.NameOID.ORGANIZATIONAL_UNIT_NAME),
+				"issuer_ST": issuer.get(x509.oid.NameOID.STATE_OR_PROVINCE_NAME),
+				"issuer_CN": issuer.get(x509.oid.NameOID.COMMON_NAME),
+				"serial_number": serial,
+				"subject_C": subject.get(x509.oid.NameOID.COUNTRY_NAME),
+				"subject_L": subject.get(x509.oid.NameOID.LOCALITY_NAME),
+				"subject_O": subject.get(x509.oid.NameOID.ORGANIZATION_NAME),
+				"subject_OU": subject.get(x509.oid.NameOID.ORGANIZATIONAL_UNIT_NAME),
+				"subject_CN": subject.get(x509.oid.NameOID.COMMON_NAME),
+				"subject_ST": subject.get(x509.oid.NameOID.STATE_OR_PROVINCE_NAME)
+			}
+
+			# add custom labels
+			for label in self.config.labels:
+				if label['name'] not in labels:
+					labels[label['name']] = label['value']
+			expiration_ts = expiration_date.timestamp()
+			issued_ts = issued_date.timestamp()
+			self._cert_cache[host_key] = (cert_hash, labels, expiration_ts, issued_ts, now)
+			return labels, expiration_ts, issued_ts, None
+		except Exception as e:
+			return None, None, None, e
+
+	def _bind_host(self, host_key, labels):
+		"""Return the bound gauge children for a host, rebinding when its labels change."""
+		bound = self._bound.get(host_key)
+		# the cert cache hands back the same labels dict until the certificate rotates
+		if bound is None or bound.labels is not labels:
+			bound = BoundHost(
+				labels=labels,
+				not_after=self.not_valid_after.labels(**labels),
+				not_before=self.not_valid_before.labels(**labels),
+				expired=self.expired.labels(**labels),
+				read_errors=self.host_read_errors.labels(host=host_key)
+			)
+			self._bound[host_key] = bound
+		return bound
+
+	async def _probe_hosts(self, hosts, now):
+		return await asyncio.gather(*[self._probe_host(host, now) for host in hosts])
+
+	def _forget_host(self, host_key):
+		"""Drop the cached certificate and exported series of a host that is no longer configured."""
+		self._cert_cache.pop(host_key, None)
+		bound = self._bound.pop(host_key, None)
+		if bound is not None:
+			label_values = list(bound.labels.values())
+			self.not_valid_after.remove(*label_values)
+			self.not_valid_before.remove(*label_values)
+			self.expired.remove(*label_values)
+		self.host_read_errors.remove(host_key)
 
 	def fetch(self):
 		hosts = self.config.hosts
 		error_count = 0
-		# loop hosts
-		for host in hosts:
-			try:
-				# get host certificate
-				cert = ssl.get_server_certificate((host['name'], host['port']))
-				# parse certificate
-				x509_cert = x509.load_pem_x509_certificate(cert.encode())
-				# get expiration date
-				expiration_date = x509_cert.not_valid_after.replace(tzinfo=pytz.UTC)
-				issued_date = x509_cert.not_valid_before.replace(tzinfo=pytz.UTC)
-				serial = x509_cert.serial_number
-				issuer = x509_cert.issuer
-				subject = x509_cert.subject
-				# get labels
-				labels = {
-					"host": f"{host['name']}:{host['port']}",
-					"issuer_C": self.get_oid_attribute(issuer, x509.oid.NameOID.COUNTRY_NAME),
-					"issuer_L": self.get_oid_attribute(issuer, x509.oid.NameOID.LOCALITY_NAME),
-					"issuer_O": self.get_oid_attribute(issuer, x509.oid.NameOID.ORGANIZATION_NAME),
-					"issuer_OU": self.get_oid_attribute(issuer, x509.oid.NameOID.ORGANIZATIONAL_UNIT_NAME),
-					"issuer_ST": self.get_oid_attribute(issuer, x509.oid.NameOID.STATE_OR_PROVINCE_NAME),
-					"issuer_CN": self.get_oid_attribute(issuer, x509.oid.NameOID.COMMON_NAME),
-					"serial_number": serial,
-					"subject_C": self.get_oid_attribute(subject, x509.oid.NameOID.COUNTRY_NAME),
-					"subject_L": self.get_oid_attribute(subject, x509.oid.NameOID.LOCALITY_NAME),
-					"subject_O": self.get_oid_attribute(subject, x509.oid.NameOID.ORGANIZATION_NAME),
-					"subject_OU": self.get_oid_attribute(subject, x509.oid.NameOID.ORGANIZATIONAL_UNIT_NAME),
-					"subject_CN": self.get_oid_attribute(subject, x509.oid.NameOID.COMMON_NAME),
-					"subject_ST": self.get_oid_attribute(subject, x509.oid.NameOID.STATE_OR_PROVINCE_NAME)
-				}
-
-				# add custom labels
-				for label in self.config.labels:
-					if label['name'] not in labels:
-						labels[label['name']] = label['value']
-				# set metrics
-				self.not_valid_after.labels(**labels).set(expiration_date.timestamp())
-				self.not_valid_before.labels(**labels).set(issued_date.timestamp())
-				self.expired.labels(**labels).set(int(expiration_date < datetime.datetime.now(pytz.UTC)))
-				self.host_read_errors.labels(host=f"{host['name']}:{host['port']}").set(0)
-			except Exception as e:
+		now = time.time()
+		# hosts can be removed by a config reload
+		host_keys = {host['_key'] for host in hosts}
+		for host_key in self._host_keys - host_keys:
+			self._forget_host(host_key)
+		self._host_keys = host_keys
+		if self._loop is None:
+			self._loop = asyncio.new_event_loop()
+		# probe all hosts concurrently on the event loop, then set metrics
+		results = self._loop.run_until_complete(self._probe_hosts(hosts, now))
+		for host, (labels, expiration_ts, issued_ts, err) in zip(hosts, results):
+			host_key = host['_key']
+			if err is not None:
 				error_count += 1
-				self.host_read_errors.labels(host=f"{host['name']}:{host['port']}").set(1)
-
+				bound = self._bound.get(host_key)
+				if bound is not None:
+					bound.read_errors.set(1)
+				else:
+					self.host_read_errors.labels(host=host_key).set(1)
+				continue
+			bound = self._bind_host(host_key, labels)
+			_set_cert_gauges(bound, expiration_ts, issued_ts, 1 if expiration_ts < now else 0)
+			bound.read_errors.set(0)
 
 		self.read_errors.set(error_count)
-def dict_get(dictionary, key, default_value = None):
-	if key in dictionary.keys():
-		return dictionary[key] or default_value
-	else:
-		return default_value
+
+def _set_cert_gauges(bound, expiration_ts, issued_ts, expired):
+	"""Set the certificate gauges of a host from its bound children.
+
+	Each child holds its own lock, so this is one acquire per gauge with no
+	label lookups in between.
+	"""
+	bound.not_after.set(expiration_ts)
+	bound.not_before.set(issued_ts)
+	bound.expired.set(expired)
+
+def _name_to_oid_map(name):
+	"""Map each OID in an x509 Name to its first value, in a single pass."""
+	values = {}
+	for attr in name:
+		values.setdefault(attr.oid, attr.value)
+	return values
+
+app_metrics = None
 
 def sighandler(signum, frame):
-	print("<SIGTERM received>")
-	exit(0)
+	log.info("<SIGTERM received>")
+	if app_metrics is None:
+		exit(0)
+	app_metrics.stop()
+
+def sighup_handler(signum, frame):
+	log.info("<SIGHUP received>")
+	if app_metrics is not None:
+		app_metrics.reload()
 
 def main():
+	global app_metrics
 	signal.signal(signal.SIGTERM, sighandler)
+	signal.signal(signal.SIGHUP, sighup_handler)
 
 	try:
-		config_file = dict_get(os.environ, "X509_CONFIG_FILE", default_value="./config/.configuration.yaml")
+		config_file = os.environ.get("X509_CONFIG_FILE") or "./config/.configuration.yaml"
 
 		config = AppConfig(config_file)
 
-		print(f"start listening on :{config.metrics['port']}")
+		log.info(f"start listening on :{config.metrics['port']}")
 		app_metrics = X509Metrics(config)
 		start_http_server(config.metrics['port'])
-		app_metrics.run_metrics_loop()
+		# poll on a worker thread so the signal handlers, which run on the main thread,
+		# never set an Event whose lock the interrupted code is holding
+		worker = threading.Thread(target=app_metrics.run_metrics_loop, name="x509-metrics")
+		worker.start()
+		worker.join()
 	except KeyboardInterrupt:
+		if app_metrics is not None:
+			app_metrics.stop()
 		exit(0)
 
 if __name__ == "__main__":